@@ -1,66 +1,261 @@
 import argparse
+import ast
+import functools
 import os
 import re
 import string
-from io import BytesIO
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
 
+import numpy as np
 import requests
 import torch
 from PIL import Image
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
+    BitsAndBytesConfig,
     CLIPImageProcessor,
     CLIPVisionModel,
+    LogitsProcessorList,
     StoppingCriteria,
+    TextIteratorStreamer,
     TextStreamer
 )
 
 from GOT.demo.process_results import punctuation_dict, svg_to_html
 from GOT.model import GOTQwenForCausalLM
-from GOT.model.plug.blip_process import BlipImageEvalProcessor
+from GOT.model.plug.blip_process import BlipImageEvalProcessor, BlipImageEvalTensorProcessor
 from GOT.utils.conversation import SeparatorStyle, conv_templates
+from GOT.utils.generation import (
+    BackgroundStreamer,
+    CUDAGraphDecoder,
+    TensorNoRepeatNGramLogitsProcessor,
+    greedy_generate
+)
 from GOT.utils.utils import KeywordsStoppingCriteria, disable_torch_init
 
-DEFAULT_IMAGE_TOKEN = "<image>"
 DEFAULT_IMAGE_PATCH_TOKEN = "<imgpad>"
 
 DEFAULT_IM_START_TOKEN = "<img>"
 DEFAULT_IM_END_TOKEN = "</img>"
 
+# The image placeholder is identical for every request.
+IMAGE_PROMPT = DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_PATCH_TOKEN * 256 + DEFAULT_IM_END_TOKEN
+
 translation_table = str.maketrans(punctuation_dict)
+# Quotes would end the JS string literal in the render template; "$" is dropped.
+markdown_translation_table = str.maketrans({'"': "``", "$": ""})
+
+# Matches the \left / \right prefix of a delimiter so it can be dropped in a single pass.
+LEFT_RIGHT_RE = re.compile(r"\\(?:left(?=[(\[{|.])|right(?=[)\]}|.]))")
+
+# Result files are written off the main thread so eval_model can return before the I/O is done.
+# A single worker runs the writes in submission order, so a newer result is never overwritten
+# by an older write to the same path.
+write_executor = ThreadPoolExecutor(max_workers=1)
+# os.umask can only be read by setting it, so do that once here rather than in the writer thread.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+DTYPES = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+
+def load_image(image_file, draft_size=None):
+    """
+    Load an image from either a local file path or a URL.
+
+    With `draft_size`, JPEG sources are decoded at the smallest DCT scale that still
+    covers that size, which is much cheaper than a full decode for large scans.
+    """
+    if image_file.startswith("http") or image_file.startswith("https"):
+        with requests.get(image_file, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            # The raw stream is not seekable, so PIL reads the body into a BytesIO itself.
+            # Decode inside the block so the connection is released afterwards.
+            return decode_image(response.raw, draft_size)
+    return decode_image(image_file, draft_size)
+
+
+def decode_image(fp, draft_size=None):
+    """Open and fully decode an image to RGB, optionally with JPEG draft decoding."""
+    image = Image.open(fp)
+    if draft_size is not None:
+        image.draft("RGB", draft_size)
+    return image.convert("RGB")
+
+
+class PromptBuilder:
+    """
+    Builds prompt ids for a query, with the conversation header and the image
+    placeholder tokenized once up front.
+
+    The prompt is split right after `</img>` and the pieces only meet at special tokens,
+    which the tokenizer never merges across, so the ids match tokenizing the whole
+    prompt in one call.
+    """
+    def __init__(self, tokenizer, conv_mode="mpt"):
+        conv = conv_templates[conv_mode].copy()
+        conv.append_message(conv.roles[0], IMAGE_PROMPT + "{query}")
+        conv.append_message(conv.roles[1], None)
+        prefix, _, self.suffix = conv.get_prompt().partition("{query}")
+        self.tokenizer = tokenizer
+        self.prefix_ids = tokenizer(prefix).input_ids
+        self.stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
+
+    def __call__(self, qs):
+        query_ids = self.tokenizer("\n" + qs + self.suffix, add_special_tokens=False).input_ids
+        return self.prefix_ids + query_ids
+
+
+def print_stream(streamer):
+    """Print text from a TextIteratorStreamer as it arrives."""
+    for text in streamer:
+        print(text, end="", flush=True)
+    print()
+
+
+def atomic_write(path, data):
+    """Write `data` to `path` via a temporary file, so readers never see a partial file."""
+    # A unique sibling per call, so concurrent writes to the same path never share it.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_f:
+            tmp_f.write(data)
+        # mkstemp creates the file as 0600; give the result the mode open() would have.
+        os.chmod(tmp_path, 0o666 & ~UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def fix_tikz_line(line):
+    """Terminate a tikz statement with ';', leaving the environment lines untouched."""
+    if "\\begin{tikzpicture}" in line or "\\end{tikzpicture}" in line:
+        return line
+    line = line.rstrip(" ")
+    if not line or line.endswith(";"):
+        return line
+    # The last character is swapped for the semicolon, not kept in front of it.
+    return line[:-1] + ";"
+
+
+@functools.lru_cache(maxsize=None)
+def load_render_template(name):
+    """Read a render template once and split it around its `const text =` placeholder."""
+    with open(os.path.join("./render_tools", name), "r") as web_f:
+        prefix, suffix = web_f.read().split("const text =", 1)
+    return prefix, suffix
+
+
+@functools.lru_cache(maxsize=None)
+def load_tokenizer(model_name):
+    """Load the tokenizer and its prompt builder once per model."""
+    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+    return tokenizer, PromptBuilder(tokenizer, conv_mode="mpt")
+
+
+def resolve_device_and_dtype(device=None, dtype="auto"):
+    """Pick the inference device and dtype, preferring CUDA with half precision."""
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    if dtype == "auto":
+        if device.startswith("cuda"):
+            # bf16 has the fp32 exponent range, so prefer it where the GPU
+            # supports it natively (Ampere and newer).
+            major, _ = torch.cuda.get_device_capability(device)
+            dtype = "bf16" if major >= 8 else "fp16"
+        else:
+            dtype = "fp32"
+    return device, DTYPES[dtype]
+
+
+def build_quantization_config(quant, dtype):
+    """Weight-only bitsandbytes config for the Qwen decoder, or None for `quant="none"`."""
+    if quant == "none":
+        return None
+    return BitsAndBytesConfig(
+        load_in_8bit=quant == "int8",
+        load_in_4bit=quant == "nf4",
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=dtype,
+        # Keep the vision path in full precision to preserve OCR feature fidelity. This list
+        # replaces the default skip list, so lm_head has to be named explicitly.
+        llm_int8_skip_modules=["vision_tower_high", "mm_projector_vary", "lm_head"],
+    )
 
 
-def load_image(image_file):
-    """Load an image from either a local file path or a URL."""
-    if image_file.startswith("http") or image_file.startswith("https"):
-        response = requests.get(image_file)
-        image = Image.open(BytesIO(response.content)).convert("RGB")
-    else:
-        image = Image.open(image_file).convert("RGB")
-    return image
+def parse_max_memory(max_memory):
+    """Parse "0=20GiB,cpu=32GiB" into the `max_memory` mapping accepted by from_pretrained."""
+    if not max_memory:
+        return None
+    limits = {}
+    for item in max_memory.split(","):
+        key, limit = item.split("=")
+        key = key.strip()
+        limits[int(key) if key.isdigit() else key] = limit.strip()
+    return limits
+
+
+def compile_model(model):
+    """Compile the model forward and the vision tower with TorchDynamo/Inductor."""
+    # The vision tower always sees a fixed 1024x1024 input, so it gets a static-shape graph.
+    vision_tower_high = model.get_model().vision_tower_high
+    vision_tower_high.forward = torch.compile(
+        vision_tower_high.forward, mode="reduce-overhead", dynamic=False
+    )
+    # generate() calls forward on the module itself, so compile the bound method in place
+    # rather than wrapping the module (which generate would bypass).
+    model.forward = torch.compile(
+        model.forward, mode="reduce-overhead", fullgraph=False, dynamic=True
+    )
+    return model
 
 
 def eval_model(args):
-    """Run the model on an input image and save or render the OCR results."""
+    """
+    Run the model on an input image and save or render the OCR results.
+
+    Returns the futures of the pending result-file writes.
+    """
     disable_torch_init()
 
+    device, dtype = resolve_device_and_dtype(args.device, args.dtype)
+    quantization_config = build_quantization_config(args.quant, dtype)
+    if quantization_config is not None and not device.startswith("cuda"):
+        raise ValueError("--quant requires a CUDA device")
+
     model_name = os.path.expanduser(args.model_name)
-    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+    tokenizer, prompt_builder = load_tokenizer(model_name)
     model = GOTQwenForCausalLM.from_pretrained(
         model_name,
         low_cpu_mem_usage=True,
         use_safetensors=True,
+        torch_dtype=dtype,
+        quantization_config=quantization_config,
+        # Materialize the weights straight on their target device in the target dtype,
+        # instead of loading on the CPU and converting with a second full copy.
+        device_map=args.device_map or {"": device},
+        max_memory=parse_max_memory(args.max_memory),
         pad_token_id=151643
     ).eval()
-    model.to(device="cpu", dtype=torch.float32)
+    if args.compile:
+        model = compile_model(model)
 
-    image_processor = BlipImageEvalProcessor(image_size=1024)
-    image_processor_high = BlipImageEvalProcessor(image_size=1024)
+    if device.startswith("cuda"):
+        image_processor = BlipImageEvalTensorProcessor(image_size=1024, device=device, dtype=dtype)
+    else:
+        image_processor = BlipImageEvalProcessor(image_size=1024)
 
-    use_im_start_end = True
-    image_token_len = 256
-    image = load_image(args.image_file)
+    # Box coordinates are given in source pixels, so keep the full decode size for them.
+    image = load_image(args.image_file, draft_size=None if args.box else (1024, 1024))
     w, h = image.size
 
     if args.type == "format":
@@ -69,15 +264,12 @@ def eval_model(args):
         qs = "OCR: "
 
     if args.box:
-        bbox = eval(args.box)
-        if len(bbox) == 2:
-            bbox[0] = int(bbox[0] / w * 1000)
-            bbox[1] = int(bbox[1] / h * 1000)
-        if len(bbox) == 4:
-            bbox[0] = int(bbox[0] / w * 1000)
-            bbox[1] = int(bbox[1] / h * 1000)
-            bbox[2] = int(bbox[2] / w * 1000)
-            bbox[3] = int(bbox[3] / h * 1000)
+        bbox = ast.literal_eval(args.box)
+        if len(bbox) not in (2, 4):
+            raise ValueError(f"--box must be [x, y] or [x1, y1, x2, y2], got {args.box}")
+        # Scale pixel coordinates to the 0-1000 range the model was trained on.
+        scale = np.array([w, h, w, h][:len(bbox)], dtype=np.float64)
+        bbox = (np.asarray(bbox, dtype=np.float64) / scale * 1000).astype(np.int64).tolist()
         if args.type == "format":
             qs = str(bbox) + " " + "OCR with format: "
         else:
@@ -89,55 +281,88 @@ def eval_model(args):
         else:
             qs = "[" + args.color + "] " + "OCR: "
 
-    if use_im_start_end:
-        qs = (
-            DEFAULT_IM_START_TOKEN
-            + DEFAULT_IMAGE_PATCH_TOKEN * image_token_len
-            + DEFAULT_IM_END_TOKEN
-            + "\n"
-            + qs
-        )
-    else:
-        qs = DEFAULT_IMAGE_TOKEN + "\n" + qs
+    input_ids = torch.as_tensor([prompt_builder(qs)], dtype=torch.long)
+    if device.startswith("cuda"):
+        input_ids = input_ids.pin_memory()
+    input_ids = input_ids.to(device, non_blocking=True)
 
-    conv_mode = "mpt"
-    args.conv_mode = conv_mode
-    conv = conv_templates[conv_mode].copy()
-    conv.append_message(conv.roles[0], qs)
-    conv.append_message(conv.roles[1], None)
-    prompt = conv.get_prompt()
+    image_tensor = image_processor(image).unsqueeze(0).to(device=device, dtype=dtype)
 
-
-    inputs = tokenizer([prompt])
-    input_ids = torch.as_tensor(inputs.input_ids, device="cpu", dtype=torch.long)
-
-    image_1 = image.copy()
-    image_tensor = image_processor(image)
-    image_tensor_1 = image_processor_high(image_1)
-
-    stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
+    stop_str = prompt_builder.stop_str
     keywords = [stop_str]
     stopping_criteria = KeywordsStoppingCriteria(keywords, tokenizer, input_ids)
     streamer = TextStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
 
-    output_ids = model.generate(
-        input_ids,
-        images=[(image_tensor.unsqueeze(0).float(), image_tensor_1.unsqueeze(0).float())],
-        do_sample=False,
-        num_beams=1,
-        no_repeat_ngram_size=20,
-        streamer=streamer,
-        max_new_tokens=4096,
-        stopping_criteria=[stopping_criteria],
-    )
+    if args.warmup:
+        # Pay the one-off compilation cost before the timed generate call.
+        dummy_image = torch.zeros(1, 3, 1024, 1024, device=device, dtype=dtype)
+        model.generate(
+            input_ids,
+            images=[(dummy_image, dummy_image)],
+            do_sample=False,
+            num_beams=1,
+            max_new_tokens=4,
+        )
+
+    # The model only reads the second (high-resolution) entry and never modifies it,
+    # so one tensor serves both.
+    images = [(image_tensor, image_tensor)]
+    max_new_tokens = 4096
+
+    if args.cuda_graph:
+        if not device.startswith("cuda"):
+            raise ValueError("--cuda-graph requires a CUDA device")
+        # Greedy decode with the per-token step replayed from a CUDA graph.
+        decoder = CUDAGraphDecoder(model, max_cache_len=input_ids.shape[1] + max_new_tokens)
+        output_ids = decoder.generate(
+            input_ids,
+            images=images,
+            max_new_tokens=max_new_tokens,
+            stopping_criteria=[stopping_criteria],
+            streamer=BackgroundStreamer(streamer),
+        )
+    elif args.greedy:
+        output_ids = greedy_generate(
+            model,
+            input_ids,
+            images=images,
+            max_new_tokens=max_new_tokens,
+            stop_token_id=tokenizer.convert_tokens_to_ids(stop_str),
+            streamer=BackgroundStreamer(streamer),
+            logits_processor=TensorNoRepeatNGramLogitsProcessor(20),
+        )
+    else:
+        # Text is printed from a worker thread, so terminal I/O never sits inside the
+        # decode loop. generate() itself stays on the main thread: the CUDA graph trees
+        # used by --compile keep thread-local state and must run where they were warmed up.
+        iterator_streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        print_thread = Thread(target=print_stream, args=(iterator_streamer,))
+        print_thread.start()
+        try:
+            output_ids = model.generate(
+                input_ids,
+                images=images,
+                do_sample=False,
+                num_beams=1,
+                # Tensor version of no_repeat_ngram_size=20, avoiding a per-token Python scan.
+                logits_processor=LogitsProcessorList([TensorNoRepeatNGramLogitsProcessor(20)]),
+                streamer=iterator_streamer,
+                max_new_tokens=max_new_tokens,
+                stopping_criteria=[stopping_criteria],
+            )
+        except BaseException:
+            # Unblock the print thread, which only stops at the end-of-stream marker.
+            iterator_streamer.end()
+            raise
+        finally:
+            print_thread.join()
 
     outputs = tokenizer.decode(output_ids[0, input_ids.shape[1]:]).strip()
     if outputs.endswith(stop_str):
         outputs = outputs[: -len(stop_str)]
     outputs = outputs.strip()
 
-    with open("ocr_output.txt", "w", encoding="utf-8") as out_f:
-        out_f.write(outputs)
+    pending_writes = [write_executor.submit(atomic_write, "ocr_output.txt", outputs)]
 
     if args.render:
         print("==============rendering===============")
@@ -145,7 +370,6 @@ def eval_model(args):
             import verovio
             from cairosvg import svg2png
             import cv2
-            import numpy as np
 
             tk = verovio.toolkit()
             tk.loadData(outputs)
@@ -166,65 +390,38 @@ def eval_model(args):
 
         if args.type == "format" and "**kern" not in outputs:
             if "\\begin{tikzpicture}" not in outputs:
-                html_path = "./render_tools/" + "/content-mmd-to-html.html"
                 html_path_2 = "./results/demo.html"
                 right_num = outputs.count("\\right")
                 left_num = outputs.count("\\left")
 
                 if right_num != left_num:
-                    outputs = outputs.replace("\\left(", "(").replace("\\right)", ")")
-                    outputs = outputs.replace("\\left[", "[").replace("\\right]", "]")
-                    outputs = outputs.replace("\\left{", "{").replace("\\right}", "}")
-                    outputs = outputs.replace("\\left|", "|").replace("\\right|", "|")
-                    outputs = outputs.replace("\\left.", ".").replace("\\right.", ".")
+                    outputs = LEFT_RIGHT_RE.sub("", outputs)
 
-                outputs = outputs.replace('"', "``").replace("$", "")
+                outputs = outputs.translate(markdown_translation_table)
 
                 outputs_list = outputs.split("\n")
-                gt = ""
-                for out in outputs_list:
-                    gt += '"' + out.replace("\\", "\\\\") + r"\n" + '"' + "+" + "\n"
-                gt = gt[:-2]
+                gt = "+\n".join(
+                    '"' + out.replace("\\", "\\\\") + r"\n" + '"' for out in outputs_list
+                )
 
-                with open(html_path, "r") as web_f:
-                    lines = web_f.read()
-                    lines = lines.split("const text =")
-                    new_web = lines[0] + "const text =" + gt + lines[1]
+                prefix, suffix = load_render_template("content-mmd-to-html.html")
+                new_web = prefix + "const text =" + gt + suffix
 
-                with open(html_path_2, "w") as web_f_new:
-                    web_f_new.write(new_web)
+                pending_writes.append(write_executor.submit(atomic_write, html_path_2, new_web))
 
             else:
-                html_path = "./render_tools/" + "/tikz.html"
                 html_path_2 = "./results/demo.html"
                 outputs = outputs.translate(translation_table)
-                outputs_list = outputs.split("\n")
-                gt = ""
-                for out in outputs_list:
-                    if out:
-                        if (
-                            "\\begin{tikzpicture}" not in out
-                            and "\\end{tikzpicture}" not in out
-                        ):
-                            while out[-1] == " ":
-                                out = out[:-1]
-                                if out is None:
-                                    break
-                            if out:
-                                if out[-1] != ";":
-                                    gt += out[:-1] + ";\n"
-                                else:
-                                    gt += out + "\n"
-                        else:
-                            gt += out + "\n"
-
-                with open(html_path, "r") as web_f:
-                    lines = web_f.read()
-                    lines = lines.split("const text =")
-                    new_web = lines[0] + gt + lines[1]
-
-                with open(html_path_2, "w") as web_f_new:
-                    web_f_new.write(new_web)
+                fixed_lines = map(fix_tikz_line, outputs.split("\n"))
+                gt = "".join(line + "\n" for line in fixed_lines if line)
+
+                # The tikz template's placeholder line is replaced outright.
+                prefix, suffix = load_render_template("tikz.html")
+                new_web = prefix + gt + suffix
+
+                pending_writes.append(write_executor.submit(atomic_write, html_path_2, new_web))
+
+    return pending_writes
 
 
 if __name__ == "__main__":
@@ -235,7 +432,26 @@ if __name__ == "__main__":
     parser.add_argument("--box", type=str, default="")
     parser.add_argument("--color", type=str, default="")
     parser.add_argument("--render", action="store_true")
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--dtype", type=str, default="auto", choices=["auto"] + list(DTYPES))
+    parser.add_argument("--device-map", type=str, default=None)
+    parser.add_argument("--max-memory", type=str, default=None)
+    parser.add_argument("--quant", type=str, default="none", choices=["none", "int8", "nf4"])
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--warmup", action="store_true")
+    parser.add_argument("--cuda-graph", action="store_true")
+    parser.add_argument("--greedy", action="store_true")
     args = parser.parse_args()
-
-    eval_model(args)
+    if args.cuda_graph and args.compile:
+        # mode="reduce-overhead" records its own CUDA graphs, which cannot be nested.
+        parser.error("--cuda-graph and --compile cannot be combined")
+    if args.cuda_graph and args.quant == "int8":
+        # LLM.int8 outlier handling syncs with the host inside the matmul, which breaks capture.
+        parser.error("--cuda-graph cannot be combined with --quant int8")
+    if args.max_memory and not args.device_map:
+        # from_pretrained only applies max_memory when it plans the placement itself.
+        parser.error("--max-memory requires --device-map (e.g. --device-map auto)")
+
+    for pending_write in eval_model(args):
+        pending_write.result()
 
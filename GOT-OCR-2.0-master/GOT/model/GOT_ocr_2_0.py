@@ -67,6 +67,30 @@ class GOTQwenModel(Qwen2Model):
             image_token_len=image_token_len,
         )
          
+    def encode_images(self, images, max_batch=1):
+        """
+        Run the vision tower and projector over every patch of a batch of images, at most
+        `max_batch` patches per vision tower call.
+
+        The global-attention blocks of the tower hold a 4096x4096 attention matrix per head
+        and patch, so peak memory grows with the batch. The default keeps the one patch at
+        a time of multi-crop inputs; with few patches in total they run in a single call.
+        """
+        patches = [image[1] for image in images]
+        cnn_features = []
+        for chunk in torch.split(torch.cat(patches, dim=0), max_batch):
+            with torch.set_grad_enabled(False):
+                cnn_feature = self.vision_tower_high(chunk)
+                cnn_feature = cnn_feature.flatten(2).permute(0, 2, 1) # max_batch*256*1024
+            cnn_features.append(cnn_feature)
+        image_feature = self.mm_projector_vary(torch.cat(cnn_features, dim=0))
+
+        # Each image's patches are laid out one after another, as a single (1, P*256, C) sequence.
+        image_features = []
+        for feature in torch.split(image_feature, [patch.shape[0] for patch in patches]):
+            image_features.append(feature.reshape(1, -1, feature.shape[-1]))
+        return image_features
+
     # def get_input_embeddings(self, x):
     #     return self.wte(x)
     
@@ -117,44 +141,9 @@ class GOTQwenModel(Qwen2Model):
             
 
 
-            image_features = []
-            
-
-            for image in images:
-                P, C, H, W = image[1].shape
-                # with torch.set_grad_enabled(True):
-                #     # print(image[1].shape)
-                #     cnn_feature = vision_tower_high(image[1])
-                #     cnn_feature = cnn_feature.flatten(2).permute(0, 2, 1) # 256  1024
-                #     # image_features.append(cnn_feature)
-                # image_features_2.append(cnn_feature)
-                if P == 1:
-                    with torch.set_grad_enabled(False):
-                        # print(image[1].shape)
-                        cnn_feature = vision_tower_high(image[1])
-                        cnn_feature = cnn_feature.flatten(2).permute(0, 2, 1) # 256*1024
-                        # image_features.append(cnn_feature)
-                    # image_features_2.append(cnn_feature)
-                    image_feature = self.mm_projector_vary(cnn_feature)
-                    image_features.append(image_feature)
-
-                else:
-                    image_patches = torch.unbind(image[1])
-                    image_patches_features = []
-                    for image_patch in image_patches:
-                        image_p = torch.stack([image_patch])
-                        with torch.set_grad_enabled(False):
-                            cnn_feature_p = vision_tower_high(image_p)
-                            cnn_feature_p = cnn_feature_p.flatten(2).permute(0, 2, 1)
-                        image_feature_p = self.mm_projector_vary(cnn_feature_p)
-                        image_patches_features.append(image_feature_p)
-                    image_feature = torch.cat(image_patches_features, dim=1)
-                    # print(P)
-                    # print(image_feature.shape)
-                    # exit()
-                    image_features.append(image_feature)
-
-
+            # Patches per vision tower call; raise it to trade memory for fewer calls.
+            vision_max_batch = getattr(self.config, "vision_max_batch", 1)
+            image_features = self.encode_images(images, max_batch=vision_max_batch)
 
             dummy_image_features_2 = torch.zeros(256, 1024, device=inputs_embeds.device, dtype=inputs_embeds.dtype)
             # dummy_image_features_2 = self.mm_projector_vary(dummy_image_features_2)
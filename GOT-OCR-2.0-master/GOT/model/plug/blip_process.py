@@ -493,6 +493,39 @@ class BlipImageEvalProcessor(BlipImageBaseProcessor):
         return self.transform(item)
 
 
+class BlipImageEvalTensorProcessor(BlipImageBaseProcessor):
+    """
+    Tensor counterpart of BlipImageEvalProcessor that resizes and normalizes on `device`,
+    so the 1024x1024 bicubic resize runs on the GPU instead of in PIL.
+    """
+    def __init__(self, image_size=384, mean=None, std=None, device="cuda", dtype=torch.float16):
+        super().__init__(mean=mean, std=std)
+        from torchvision.transforms import v2
+
+        self.device = device
+        self.transform = v2.Compose(
+            [
+                # Resize while still uint8: torchvision rounds and clamps the bicubic overshoot
+                # back to [0, 255], as PIL does for BlipImageEvalProcessor.
+                v2.Resize(
+                    (image_size, image_size), interpolation=InterpolationMode.BICUBIC, antialias=True
+                ),
+                v2.ToDtype(torch.float32, scale=True),
+                self.normalize,
+                v2.ToDtype(dtype),
+            ]
+        )
+
+    def __call__(self, item):
+        if isinstance(item, Image.Image):
+            item = transforms.functional.pil_to_tensor(item)
+        if torch.device(self.device).type == "cuda" and not item.is_cuda:
+            # Only a copy from pinned memory is actually asynchronous.
+            item = item.pin_memory()
+        item = item.to(self.device, non_blocking=True)
+        return self.transform(item)
+
+
 # if __name__ == "__main__":
 #     a = BlipImageTrainProcessor(image_size=1024)
 #     # img = np.random.randn(1024, 1024, 3)
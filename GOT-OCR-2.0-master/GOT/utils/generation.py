@@ -0,0 +1,280 @@
+import bisect
+import queue
+import threading
+
+import torch
+from transformers import LogitsProcessor
+from transformers.cache_utils import Cache
+
+
+class StaticCache(Cache):
+    """
+    KV cache backed by preallocated buffers, so that every decode step sees the
+    same shapes and tensor addresses and can be captured in a CUDA graph.
+    """
+    def __init__(self, config, max_cache_len, device, dtype, batch_size=1):
+        head_dim = config.hidden_size // config.num_attention_heads
+        shape = (batch_size, config.num_key_value_heads, max_cache_len, head_dim)
+        self.key_cache = [
+            torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.num_hidden_layers)
+        ]
+        self.value_cache = [
+            torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.num_hidden_layers)
+        ]
+        self.max_cache_len = max_cache_len
+        # Number of leading slots attention runs over; lets decode graphs be bucketed by KV length.
+        self.active_len = max_cache_len
+        # Slots written by the next forward pass, set by the caller before each step.
+        self.cache_position = None
+        self.seen_tokens = 0
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        self.key_cache[layer_idx].index_copy_(2, self.cache_position, key_states)
+        self.value_cache[layer_idx].index_copy_(2, self.cache_position, value_states)
+        return (
+            self.key_cache[layer_idx][:, :, :self.active_len],
+            self.value_cache[layer_idx][:, :, :self.active_len],
+        )
+
+    def get_seq_length(self, layer_idx=0):
+        return self.seen_tokens
+
+    def get_max_length(self):
+        return self.max_cache_len
+
+    def get_usable_length(self, new_seq_length, layer_idx=0):
+        # Attention always runs over all active slots; unwritten ones are masked out.
+        return self.active_len - new_seq_length
+
+
+class BackgroundStreamer:
+    """
+    Forwards `put`/`end` to a streamer on a worker thread, so detokenizing and printing
+    do not stall the decode loop.
+    """
+    def __init__(self, streamer):
+        self.streamer = streamer
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            value = self.queue.get()
+            if value is None:
+                self.streamer.end()
+                return
+            self.streamer.put(value)
+
+    def put(self, value):
+        self.queue.put(value)
+
+    def end(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class TensorNoRepeatNGramLogitsProcessor(LogitsProcessor):
+    """
+    Same ban as `no_repeat_ngram_size`, computed with tensor ops on the device of the
+    scores instead of a per-step Python scan over the generated sequence.
+    """
+    def __init__(self, ngram_size):
+        if ngram_size < 1:
+            raise ValueError(f"`ngram_size` has to be a strictly positive integer, but is {ngram_size}")
+        self.ngram_size = ngram_size
+
+    def __call__(self, input_ids, scores):
+        num_ngrams = input_ids.shape[1] - self.ngram_size + 1
+        if num_ngrams <= 0:
+            return scores
+        prefix_len = self.ngram_size - 1
+        completions = input_ids[:, prefix_len:]
+        if prefix_len == 0:
+            matches = torch.ones_like(completions, dtype=torch.int32)
+        else:
+            # Every earlier n-gram whose first n-1 tokens equal the last n-1 tokens bans
+            # the token that completed it.
+            windows = input_ids[:, :-1].unfold(1, prefix_len, 1)
+            matches = (windows == input_ids[:, None, -prefix_len:]).all(dim=-1).int()
+        banned = torch.zeros_like(scores, dtype=torch.int32)
+        banned.scatter_add_(1, completions, matches)
+        return scores.masked_fill(banned > 0, -float("inf"))
+
+
+class CUDAGraphDecoder:
+    """
+    Greedy decoder that replays captured CUDA graphs for every token after the prefill.
+
+    Only the single-token decode step is captured. Its input id, position and KV cache
+    live in static buffers, and the graph writes the argmax token back into the input
+    buffer and advances the position itself, so a replay needs no host-side inputs.
+
+    One graph is captured per KV-length bucket, so that attention only runs over the
+    slots that can hold tokens yet. The graph for the next bucket is captured on a side
+    stream while the GPU replays the current one, hiding the capture cost behind decode.
+    Graphs are kept and reused for later images.
+    """
+    def __init__(self, model, max_cache_len, bucket_size=512):
+        if getattr(model.config, "_attn_implementation", None) == "flash_attention_2":
+            raise ValueError("CUDA graph decoding needs 4D attention masks, which flash_attention_2 does not support.")
+        param = next(model.parameters())
+        self.model = model
+        self.device = param.device
+        self.dtype = param.dtype
+        self.cache = StaticCache(model.config, max_cache_len, self.device, self.dtype)
+        self.input_ids = torch.zeros((1, 1), device=self.device, dtype=torch.long)
+        self.position_ids = torch.zeros((1, 1), device=self.device, dtype=torch.long)
+        self.slots = torch.arange(max_cache_len, device=self.device)
+        self.buckets = list(range(bucket_size, max_cache_len, bucket_size)) + [max_cache_len]
+        self.graphs = {}
+        # Graphs replay strictly one after another, so they can share one memory pool.
+        self.pool = torch.cuda.graph_pool_handle()
+        self.build_stream = torch.cuda.Stream()
+        self.built = torch.cuda.Event()
+        self.warmed_up = False
+
+    def _bucket(self, position):
+        """Smallest bucket that has a slot for `position`."""
+        return self.buckets[bisect.bisect_right(self.buckets, position)]
+
+    def _forward(self, input_ids, position_ids, images=None):
+        self.cache.cache_position = position_ids.view(-1)
+        # (1, 1, q_len, active_len), ones on the slots each query may attend to.
+        slots = self.slots[None, :self.cache.active_len]
+        attention_mask = (slots <= position_ids.view(-1, 1))[None, None].to(self.dtype)
+        outputs = self.model(
+            input_ids=input_ids,
+            position_ids=position_ids,
+            attention_mask=attention_mask,
+            past_key_values=self.cache,
+            use_cache=True,
+            images=images,
+            return_dict=True,
+        )
+        return outputs.logits[:, -1]
+
+    def _step(self):
+        logits = self._forward(self.input_ids, self.position_ids)
+        self.input_ids.copy_(logits.argmax(dim=-1, keepdim=True))
+        self.position_ids.add_(1)
+
+    def _warmup(self, num_warmup=3):
+        # Each warm-up step advances the static inputs, so they are restored before every
+        # step. That keeps all steps at the current position, inside the active bucket;
+        # the KV slot they write is rewritten by the first replay before it is attended to.
+        input_ids = self.input_ids.clone()
+        position_ids = self.position_ids.clone()
+
+        # Run a few eager steps on a side stream so lazy cuBLAS and allocator
+        # initialisation does not end up in a graph.
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(num_warmup):
+                self.input_ids.copy_(input_ids)
+                self.position_ids.copy_(position_ids)
+                self._step()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.input_ids.copy_(input_ids)
+        self.position_ids.copy_(position_ids)
+        self.warmed_up = True
+
+    def _capture(self, bucket):
+        graph = torch.cuda.CUDAGraph()
+        self.cache.active_len = bucket
+        # Capture with the raw API on the build stream: torch.cuda.graph() synchronizes
+        # the device on entry, which would stall the replay we want to overlap with.
+        with torch.cuda.stream(self.build_stream):
+            graph.capture_begin(pool=self.pool)
+            try:
+                self._step()
+            finally:
+                graph.capture_end()
+            self.built.record(self.build_stream)
+        self.graphs[bucket] = graph
+
+    def _replay(self, position):
+        bucket = self._bucket(position)
+        if bucket not in self.graphs:
+            self._capture(bucket)
+        torch.cuda.current_stream().wait_event(self.built)
+        self.graphs[bucket].replay()
+
+        # Capture the next bucket while the GPU is busy with this token.
+        next_index = self.buckets.index(bucket) + 1
+        if next_index < len(self.buckets) and self.buckets[next_index] not in self.graphs:
+            self._capture(self.buckets[next_index])
+
+    @torch.no_grad()
+    def generate(self, input_ids, images, max_new_tokens, stopping_criteria=None, streamer=None):
+        prompt_len = input_ids.shape[1]
+        if prompt_len + max_new_tokens > self.cache.max_cache_len:
+            raise ValueError(
+                f"Prompt of {prompt_len} tokens plus {max_new_tokens} new tokens does not fit "
+                f"in a cache of {self.cache.max_cache_len} slots."
+            )
+
+        self.cache.active_len = self._bucket(prompt_len - 1)
+        position_ids = torch.arange(prompt_len, device=self.device)[None]
+        logits = self._forward(input_ids.to(self.device, non_blocking=True), position_ids, images=images)
+        self.input_ids.copy_(logits.argmax(dim=-1, keepdim=True))
+        self.position_ids.fill_(prompt_len)
+        if not self.warmed_up:
+            self.cache.active_len = self._bucket(prompt_len)
+            self._warmup()
+
+        output_ids = input_ids.cpu()
+        if streamer is not None:
+            streamer.put(output_ids)
+        for step in range(max_new_tokens):
+            next_ids = self.input_ids.cpu()
+            output_ids = torch.cat([output_ids, next_ids], dim=1)
+            self.cache.seen_tokens = output_ids.shape[1]
+            if streamer is not None:
+                streamer.put(next_ids[0])
+            if stopping_criteria is not None and any(c(output_ids, None) for c in stopping_criteria):
+                break
+            if step + 1 < max_new_tokens:
+                self._replay(prompt_len + step)
+
+        if streamer is not None:
+            streamer.end()
+        return output_ids
+
+
+@torch.no_grad()
+def greedy_generate(model, input_ids, images, max_new_tokens, stop_token_id=None, streamer=None,
+                    logits_processor=None):
+    """
+    Plain greedy decoding with a KV cache, equivalent to `generate(do_sample=False, num_beams=1)`
+    without its per-token bookkeeping. Stops after `stop_token_id` (which is kept in the output)
+    or after `max_new_tokens` tokens.
+    """
+    output_ids = input_ids
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+
+    # Images are only consumed by the prefill; decode steps feed one token at a time.
+    model_inputs = {"input_ids": input_ids, "images": images}
+    past_key_values = None
+    for _ in range(max_new_tokens):
+        outputs = model(**model_inputs, past_key_values=past_key_values, use_cache=True, return_dict=True)
+        past_key_values = outputs.past_key_values
+        logits = outputs.logits[:, -1]
+        if logits_processor is not None:
+            logits = logits_processor(output_ids, logits)
+        next_ids = logits.argmax(dim=-1, keepdim=True)
+        output_ids = torch.cat([output_ids, next_ids], dim=1)
+
+        next_token = next_ids[0].cpu()
+        if streamer is not None:
+            streamer.put(next_token)
+        if next_token.item() == stop_token_id:
+            break
+        model_inputs = {"input_ids": next_ids}
+
+    if streamer is not None:
+        streamer.end()
+    return output_ids